@@ -0,0 +1,113 @@
+''' Host-side benchmark of map marker touch lookup.
+
+Compares KDTree.nearest from code.py against a linear scan of
+every marker, the lookup used before the tree, for 15, 150 and
+1500 places on a 320x240 screen.
+
+    python3 benchmark_index.py
+    python3 benchmark_index.py --counts 15 150 1500 --touches 2000
+
+Function and class definitions are loaded from code.py, with
+its CircuitPython hardware modules replaced by empty modules.
+'''
+
+import argparse
+import os
+import random
+import sys
+import time
+import types
+
+
+# CircuitPython modules imported by code.py
+DEVICE_MODULES = [
+    "board", "busio", "displayio", "terminalio", "neopixel", "digitalio",
+    "adafruit_touchscreen", "adafruit_imageload", "adafruit_bitmap_font",
+    "adafruit_display_shapes", "adafruit_display_shapes.rect",
+    "adafruit_display_shapes.circle", "adafruit_display_text",
+    "adafruit_esp32spi", "adafruit_requests", "secrets"
+]
+
+# Names imported from the CircuitPython modules
+DEVICE_NAMES = [
+    ("adafruit_bitmap_font", "bitmap_font"),
+    ("adafruit_display_shapes.rect", "Rect"),
+    ("adafruit_display_shapes.circle", "Circle"),
+    ("adafruit_display_text", "label"),
+    ("adafruit_display_text", "wrap_text_to_pixels"),
+    ("adafruit_esp32spi", "adafruit_esp32spi"),
+    ("adafruit_esp32spi", "adafruit_esp32spi_wifimanager"),
+    ("adafruit_esp32spi", "adafruit_esp32spi_socket"),
+    ("secrets", "secrets")
+]
+
+
+def load_definitions(fname):
+    ''' Return namespace of the definitions in input code.py
+        file, up to the start of its device setup '''
+
+    for name in DEVICE_MODULES:
+        sys.modules.setdefault(name, types.ModuleType(name))
+    for module, name in DEVICE_NAMES:
+        setattr(sys.modules[module], name, None)
+
+    with open(fname, "r") as file:
+        source = file.read()
+    source = source[:source.index("# Create display")]
+    namespace = {"__name__": "code"}
+    exec(compile(source, fname, "exec"), namespace)
+    return namespace
+
+
+def linear_nearest(xs, ys, radius, x, y):
+    ''' Return index of marker nearest to input x/y coordinate
+        within input radius, checking every marker, or None '''
+
+    nearest = None
+    best = radius * radius
+    for i in range(len(xs)):
+        distance = (xs[i] - x) ** 2 + (ys[i] - y) ** 2
+        if distance <= best:
+            nearest = i
+            best = distance
+    return nearest
+
+
+def time_lookups(lookup, touches):
+    ''' Return mean time (us) of input lookup function over
+        input touch coordinates '''
+
+    start = time.perf_counter()
+    for x, y in touches:
+        lookup(x, y)
+    return (time.perf_counter() - start) / len(touches) * 1000000
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark map marker touch lookup")
+    parser.add_argument("--counts", type=int, nargs="+", default=[15, 150, 1500])
+    parser.add_argument("--touches", type=int, default=2000)
+    parser.add_argument("--width", type=int, default=320)
+    parser.add_argument("--height", type=int, default=240)
+    parser.add_argument("--radius", type=int, default=20)
+    args = parser.parse_args()
+
+    code = load_definitions(os.path.join(os.path.dirname(os.path.abspath(__file__)), "code.py"))
+    random.seed(1)
+    touches = [
+        (random.randrange(args.width), random.randrange(args.height))
+        for _ in range(args.touches)
+    ]
+
+    print("%8s %12s %12s" % ("places", "KDTree us", "linear us"))
+    for count in args.counts:
+        xs = [random.randrange(args.width) for _ in range(count)]
+        ys = [random.randrange(args.height) for _ in range(count)]
+        tree = code["KDTree"](xs, ys, list(range(count)))
+        tree_us = time_lookups(lambda x, y: tree.nearest(x, y, args.radius), touches)
+        linear_us = time_lookups(lambda x, y: linear_nearest(xs, ys, args.radius, x, y), touches)
+        print("%8d %12.1f %12.1f" % (count, tree_us, linear_us))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,187 @@
+''' Host-side check of download_file against map_converter.py.
+
+Runs download_file from code.py over HTTP against the map
+converter server, which converts a generated PNG served by a
+local source server, and checks each download case:
+
+    first download        200, file written
+    repeated download     304, file kept, cache hit counted
+    validators removed    200, identical data, file kept
+    interrupted download  206, resumed from the temporary file
+
+    python3 check_downloads.py
+
+The ESP32 WiFi manager is replaced with a client using the
+Python standard library.
+'''
+
+import binascii
+import http.client
+import http.server
+import os
+import struct
+import sys
+import tempfile
+import threading
+import types
+import urllib.parse
+import zlib
+
+import map_converter
+from benchmark_index import load_definitions
+
+
+def make_png(width, height):
+    ''' Return PNG data of an RGB test pattern '''
+
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+    rows = b"".join([
+        b"\x00" + bytes([(x * 7 + y * 3) % 256 for x in range(width) for _ in range(3)])
+        for y in range(height)
+    ])
+    return (
+        map_converter.PNG_SIGNATURE
+        + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+        + chunk(b"IDAT", zlib.compress(rows))
+        + chunk(b"IEND", b"")
+    )
+
+
+class Response:
+    ''' Streamed response with the adafruit_requests methods
+        used by download_file '''
+
+    def __init__(self, response):
+        self.response = response
+        self.status_code = response.status
+        self.headers = dict(response.getheaders())
+
+    def iter_content(self, chunk_size):
+        while True:
+            data = self.response.read(chunk_size)
+            if not data:
+                return
+            yield data
+
+    def _readinto(self, buffer):
+        return self.response.readinto(buffer)
+
+    def close(self):
+        self.response.close()
+
+
+class WiFi:
+    ''' WiFi manager making requests with http.client '''
+
+    def get(self, url, headers=None, stream=True):
+        parts = urllib.parse.urlsplit(url)
+        connection = http.client.HTTPConnection(parts.netloc)
+        connection.request("GET", parts.path + "?" + parts.query, headers=headers or {})
+        return Response(connection.getresponse())
+
+
+class SourceHandler(http.server.BaseHTTPRequestHandler):
+    ''' Serve the test PNG '''
+
+    png = b""
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "image/png")
+        self.send_header("Content-Length", str(len(self.png)))
+        self.end_headers()
+        self.wfile.write(self.png)
+
+    def log_message(self, *args):
+        pass
+
+
+class QuietConverterHandler(map_converter.ConverterHandler):
+    ''' Map converter without request logging '''
+
+    def log_message(self, *args):
+        pass
+
+
+def start_server(handler):
+    ''' Start input handler on a free local port, returning
+        its address '''
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return "127.0.0.1:%d" % server.server_port
+
+
+def check(name, condition):
+    ''' Print result of a named check, returning it '''
+
+    print("%-5s %s" % ("ok" if condition else "FAIL", name))
+    return condition
+
+
+def main():
+    code = load_definitions(os.path.join(os.path.dirname(os.path.abspath(__file__)), "code.py"))
+    code["wifi"] = WiFi()
+    code["esp"] = types.SimpleNamespace(get_host_by_name=lambda host: b"\x7f\x00\x00\x01")
+    code["gc"] = types.SimpleNamespace(mem_alloc=lambda: 0)
+    code["metrics"] = code["Metrics"]()
+    code["resolved_hosts"] = set()
+    download_file = code["download_file"]
+
+    with tempfile.TemporaryDirectory() as directory:
+        SourceHandler.png = make_png(64, 48)
+        QuietConverterHandler.cache_dir = os.path.join(directory, "cache")
+        source = start_server(SourceHandler)
+        converter = start_server(QuietConverterHandler)
+        url = code["build_url"]("http://%s/image-formatter" % converter, {
+            "width": 32,
+            "height": 24,
+            "output": "BMP16",
+            "url": code["url_encode"]("http://%s/map.png" % source)
+        })
+        fname = os.path.join(directory, "map.bmp")
+        operation = "download " + fname
+        results = []
+
+        # First download
+        crc, changed = download_file(url, fname, chunk_size=256, buffer=bytearray(256))
+        with open(fname, "rb") as file:
+            data = file.read()
+        results.append(check("200 writes file", changed and crc == binascii.crc32(data) and data[:2] == b"BM"))
+
+        # Revalidation with the stored ETag
+        crc, changed = download_file(url, fname, chunk_size=256)
+        with open(fname, "rb") as file:
+            kept = file.read() == data
+        hits = code["metrics"].operations[operation].get("cache_hits", 0)
+        results.append(check("304 keeps file and counts cache hit", crc is None and not changed and kept and hits == 1))
+
+        # Full download of identical data
+        os.remove(fname + ".meta")
+        crc, changed = download_file(url, fname, chunk_size=256)
+        results.append(check("200 with identical data keeps file", crc == binascii.crc32(data) and not changed))
+
+        # Resume of an interrupted download
+        os.remove(fname)
+        with open(fname + ".meta", "r") as file:
+            meta = code["json"].load(file)
+        meta["partial"] = {"url": meta["url"], "validator": meta["etag"]}
+        with open(fname + ".meta", "w") as file:
+            code["json"].dump(meta, file)
+        with open(fname + ".tmp", "wb") as file:
+            file.write(data[:len(data) // 3])
+        received = code["metrics"].operations[operation]["bytes"]
+        crc, changed = download_file(url, fname, chunk_size=256, buffer=bytearray(256))
+        with open(fname, "rb") as file:
+            resumed = file.read() == data
+        received = code["metrics"].operations[operation]["bytes"] - received
+        results.append(check("206 resumes partial download", changed and resumed and received == len(data) - len(data) // 3))
+
+    code["metrics"].report()
+    sys.exit(0 if all(results) else 1)
+
+
+if __name__ == "__main__":
+    main()
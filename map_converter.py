@@ -0,0 +1,486 @@
+''' Host-side map image converter for the PyPortal accessibility map.
+
+Converts Geoapify PNG maps into the 16-bit BMP layout read by
+displayio.OnDiskBitmap, replacing the Adafruit IO image-formatter
+request, or into 1, 2, 4 or 8-bit palette BMPs (BMP1 to BMP8
+outputs) that are several times smaller for the toner map style.
+Uses only the Python standard library.
+
+    python3 map_converter.py convert map.png map.bmp --width 320 --height 240 --output BMP2
+    python3 map_converter.py benchmark map.png --width 320 --height 240
+    python3 map_converter.py serve --port 8000 --cache map_cache
+
+When serving, set map_converter_url in code.py to the server address,
+e.g. "http://192.168.1.10:8000/image-formatter". Converted maps are
+kept in the cache directory, keyed by request, and served with ETag
+and Range support so kiosks revalidate and resume like any download.
+'''
+
+import argparse
+import binascii
+import email.utils
+import http.server
+import os
+import struct
+import time
+import urllib.parse
+import urllib.request
+import zlib
+
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+# sRGB color space, endpoints and gamma of BMP16 headers
+BMP_COLOR_SPACE = bytes.fromhex(
+    "42475273"
+    "8fc2f52851b81e151e85eb01333333136666662666666606999999093d0ad703285c8f32"
+    "000000000000000000000000"
+)
+
+# Bits per pixel of output formats. Indexed formats of 1, 2,
+# 4 and 8 bits are all rendered by displayio.OnDiskBitmap,
+# though few other programs read 2-bit BMP files
+OUTPUT_BITS = {"BMP1": 1, "BMP2": 2, "BMP4": 4, "BMP8": 8, "BMP16": 16}
+
+# Channels per pixel of PNG color types
+PNG_CHANNELS = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
+
+
+def read_chunks(data):
+    ''' Yield type and data of each PNG chunk '''
+
+    if data[:8] != PNG_SIGNATURE:
+        raise ValueError("Not a PNG image")
+    pos = 8
+    while pos + 8 <= len(data):
+        length, kind = struct.unpack(">I4s", data[pos:pos + 8])
+        yield kind, data[pos + 8:pos + 8 + length]
+        pos += length + 12
+
+
+def unfilter(raw, height, bpp, stride):
+    ''' Return PNG scanlines with filters removed, as one
+        bytearray of height rows of stride bytes '''
+
+    out = bytearray(stride * height)
+    prior = bytearray(stride)
+    pos = 0
+    for y in range(height):
+        kind = raw[pos]
+        line = bytearray(raw[pos + 1:pos + 1 + stride])
+        pos += stride + 1
+        if kind == 1:
+            for i in range(bpp, stride):
+                line[i] = (line[i] + line[i - bpp]) & 0xFF
+        elif kind == 2:
+            line = bytearray([(a + b) & 0xFF for a, b in zip(line, prior)])
+        elif kind == 3:
+            for i in range(stride):
+                left = line[i - bpp] if i >= bpp else 0
+                line[i] = (line[i] + ((left + prior[i]) >> 1)) & 0xFF
+        elif kind == 4:
+            for i in range(stride):
+                a = line[i - bpp] if i >= bpp else 0
+                b = prior[i]
+                c = prior[i - bpp] if i >= bpp else 0
+                pa = abs(b - c)
+                pb = abs(a - c)
+                pc = abs(a + b - c - c)
+                if pa <= pb and pa <= pc:
+                    line[i] = (line[i] + a) & 0xFF
+                elif pb <= pc:
+                    line[i] = (line[i] + b) & 0xFF
+                else:
+                    line[i] = (line[i] + c) & 0xFF
+        elif kind != 0:
+            raise ValueError("Unknown PNG filter %d" % kind)
+        out[y * stride:(y + 1) * stride] = line
+        prior = line
+    return out
+
+
+def read_png(data, background=(255, 255, 255)):
+    ''' Return width, height and RGB pixel bytes of input PNG
+        data, blending any transparency over input background '''
+
+    palette = None
+    transparency = None
+    idat = []
+    for kind, chunk in read_chunks(data):
+        if kind == b"IHDR":
+            width, height, depth, color, _, _, interlace = struct.unpack(">IIBBBBB", chunk)
+        elif kind == b"PLTE":
+            palette = chunk
+        elif kind == b"tRNS":
+            transparency = chunk
+        elif kind == b"IDAT":
+            idat.append(chunk)
+        elif kind == b"IEND":
+            break
+    if interlace:
+        raise ValueError("Interlaced PNG images are not supported")
+
+    # Remove filters from decompressed scanlines
+    channels = PNG_CHANNELS[color]
+    bits = depth * channels
+    stride = (width * bits + 7) // 8
+    raw = unfilter(zlib.decompress(b"".join(idat)), height, max(1, bits // 8), stride)
+
+    # Keep high byte of 16-bit samples
+    if depth == 16:
+        raw = raw[::2]
+        stride //= 2
+
+    # Unpack samples of less than 8 bits into bytes
+    if depth < 8:
+        samples = bytearray(width * height)
+        per_byte = 8 // depth
+        mask = (1 << depth) - 1
+        scale = 255 // mask if color == 0 else 1
+        for y in range(height):
+            row = raw[y * stride:(y + 1) * stride]
+            base = y * width
+            for x in range(width):
+                shift = 8 - depth * (x % per_byte + 1)
+                samples[base + x] = ((row[x // per_byte] >> shift) & mask) * scale
+        raw = samples
+
+    # Expand samples to RGB, with optional alpha
+    if color == 3:
+        alpha = bytearray(transparency or b"") + b"\xff" * (256 - len(transparency or b""))
+        table = [palette[i * 3:i * 3 + 3] + alpha[i:i + 1] for i in range(len(palette) // 3)]
+        rgba = b"".join([table[i] for i in raw])
+    elif color == 0:
+        rgba = bytes(b for v in raw for b in (v, v, v, 255))
+    elif color == 4:
+        rgba = bytes(b for i in range(0, len(raw), 2) for b in (raw[i], raw[i], raw[i], raw[i + 1]))
+    elif color == 2:
+        rgba = None
+        rgb = bytes(raw)
+    else:
+        rgba = bytes(raw)
+
+    if rgba is not None:
+        rgb = bytearray(width * height * 3)
+        rgb[0::3] = rgba[0::4]
+        rgb[1::3] = rgba[1::4]
+        rgb[2::3] = rgba[2::4]
+        alphas = rgba[3::4]
+        if alphas.count(255) != len(alphas):
+            for i, a in enumerate(alphas):
+                if a != 255:
+                    for c in range(3):
+                        rgb[i * 3 + c] = (rgb[i * 3 + c] * a + background[c] * (255 - a)) // 255
+    return width, height, bytes(rgb)
+
+
+def resample(rgb, width, height, new_width, new_height):
+    ''' Return RGB pixel bytes resized to input dimensions,
+        averaging the source pixels covered by each output
+        pixel '''
+
+    if (width, height) == (new_width, new_height):
+        return rgb
+
+    # Source column ranges covered by each output column
+    columns = []
+    for x in range(new_width):
+        x0 = x * width // new_width
+        x1 = max(x0 + 1, (x + 1) * width // new_width)
+        columns.append((x0 * 3, x1 * 3, x1 - x0))
+
+    out = bytearray(new_width * new_height * 3)
+    pos = 0
+    for y in range(new_height):
+        y0 = y * height // new_height
+        y1 = max(y0 + 1, (y + 1) * height // new_height)
+        rows = [rgb[row * width * 3:(row + 1) * width * 3] for row in range(y0, y1)]
+        for start, end, span in columns:
+            count = span * len(rows)
+            for c in range(3):
+                out[pos + c] = sum([sum(row[start + c:end:3]) for row in rows]) // count
+            pos += 3
+    return bytes(out)
+
+
+def write_bmp16(rgb, width, height):
+    ''' Return BMP file bytes of RGB pixels in the layout of
+        Adafruit IO BMP16 output: BITMAPV5HEADER, RGB565 bit
+        fields, bottom-up rows padded to 4 bytes '''
+
+    stride = (width * 2 + 3) & ~3
+    size = stride * height
+    offset = 14 + 124
+    header = struct.pack("<2sIHHI", b"BM", offset + size, 0, 0, offset)
+    info = struct.pack(
+        "<IiiHHIIiiII",
+        124, width, height, 1, 16, 3, size, 0, 0, 0, 0
+    )
+    info += struct.pack("<IIII", 0xF800, 0x07E0, 0x001F, 0)
+    info += BMP_COLOR_SPACE
+    info += struct.pack("<IIII", 4, 0, 0, 0)
+
+    pixels = bytearray(size)
+    padding = stride - width * 2
+    for y in range(height):
+        row = rgb[(height - 1 - y) * width * 3:(height - y) * width * 3]
+        line = bytearray(width * 2)
+        for x in range(width):
+            r, g, b = row[x * 3:x * 3 + 3]
+            value = ((r & 0xF8) << 8) | ((g & 0xFC) << 3) | (b >> 3)
+            line[x * 2] = value & 0xFF
+            line[x * 2 + 1] = value >> 8
+        pixels[y * stride:y * stride + width * 2] = line
+        if padding:
+            pixels[y * stride + width * 2:(y + 1) * stride] = bytes(padding)
+    return header + info + bytes(pixels)
+
+
+def quantize(rgb, colors):
+    ''' Return palette of up to input number of colors and
+        palette index bytes of RGB pixels
+
+        The palette holds the average colors of the most
+        common bins of similar colors, and pixels are mapped
+        to their nearest palette color.
+    '''
+
+    bins = {}
+    for i in range(0, len(rgb), 3):
+        r, g, b = rgb[i:i + 3]
+        key = (r & 0xF0, g & 0xF0, b & 0xF0)
+        totals = bins.get(key)
+        if totals is None:
+            bins[key] = [1, r, g, b]
+        else:
+            totals[0] += 1
+            totals[1] += r
+            totals[2] += g
+            totals[3] += b
+    common = sorted(bins.values(), reverse=True)[:colors]
+    palette = [(r // n, g // n, b // n) for n, r, g, b in common]
+
+    indices = bytearray(len(rgb) // 3)
+    nearest = {}
+    for i in range(len(indices)):
+        color = rgb[i * 3:i * 3 + 3]
+        index = nearest.get(color)
+        if index is None:
+            r, g, b = color
+            index = min(range(len(palette)), key=lambda p: (
+                (palette[p][0] - r) ** 2 + (palette[p][1] - g) ** 2 + (palette[p][2] - b) ** 2
+            ))
+            nearest[color] = index
+        indices[i] = index
+    return palette, bytes(indices)
+
+
+def write_bmp_indexed(indices, palette, width, height, bits):
+    ''' Return BMP file bytes of palette index pixels, with
+        input bits per pixel: BITMAPINFOHEADER, BGRA color
+        table, bottom-up rows packed high bits first and padded
+        to 4 bytes '''
+
+    stride = ((width * bits + 31) // 32) * 4
+    size = stride * height
+    offset = 14 + 40 + 4 * len(palette)
+    header = struct.pack("<2sIHHI", b"BM", offset + size, 0, 0, offset)
+    info = struct.pack(
+        "<IiiHHIIiiII",
+        40, width, height, 1, bits, 0, size, 0, 0, len(palette), len(palette)
+    )
+    table = b"".join([bytes((b, g, r, 0)) for r, g, b in palette])
+
+    pixels = bytearray(size)
+    per_byte = 8 // bits
+    for y in range(height):
+        row = indices[(height - 1 - y) * width:(height - y) * width]
+        base = y * stride
+        if bits == 8:
+            pixels[base:base + width] = row
+            continue
+        for x in range(width):
+            pixels[base + x // per_byte] |= row[x] << (8 - bits * (x % per_byte + 1))
+    return header + info + table + bytes(pixels)
+
+
+def encode(rgb, width, height, output="BMP16"):
+    ''' Return BMP bytes of RGB pixels in input output
+        format '''
+
+    bits = OUTPUT_BITS[output]
+    if bits == 16:
+        return write_bmp16(rgb, width, height)
+    palette, indices = quantize(rgb, 1 << bits)
+    return write_bmp_indexed(indices, palette, width, height, bits)
+
+
+def convert(png, width, height, output="BMP16"):
+    ''' Return BMP bytes of input PNG data resized to input
+        dimensions, in input output format '''
+
+    src_width, src_height, rgb = read_png(png)
+    rgb = resample(rgb, src_width, src_height, width, height)
+    return encode(rgb, width, height, output)
+
+
+def benchmark(png, width, height, repeat=3, outputs=OUTPUT_BITS):
+    ''' Print best time of each conversion stage for input
+        PNG data, and size and encode time of each output
+        format '''
+
+    timings = {"decode": [], "resample": []}
+    for _ in range(repeat):
+        start = time.perf_counter()
+        src_width, src_height, rgb = read_png(png)
+        decoded = time.perf_counter()
+        resampled_rgb = resample(rgb, src_width, src_height, width, height)
+        timings["decode"].append(decoded - start)
+        timings["resample"].append(time.perf_counter() - decoded)
+
+    print("%dx%d PNG (%d bytes) -> %dx%d" % (src_width, src_height, len(png), width, height))
+    for stage, values in timings.items():
+        print("%-9s %8.1f ms" % (stage, min(values) * 1000))
+
+    for output in outputs:
+        values = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            bmp = encode(resampled_rgb, width, height, output)
+            values.append(time.perf_counter() - start)
+        print("%-9s %8.1f ms  %7d bytes" % (output, min(values) * 1000, len(bmp)))
+
+
+def cache_key(url, width, height, output):
+    ''' Return cache file name of a conversion request, with
+        the map URL API key removed '''
+
+    parts = urllib.parse.urlsplit(url)
+    query = [
+        (key, value) for key, value in urllib.parse.parse_qsl(parts.query)
+        if key != "apiKey"
+    ]
+    normalized = "|".join([
+        parts.netloc + parts.path,
+        urllib.parse.urlencode(sorted(query)),
+        str(width), str(height), output
+    ])
+    return "%08x.bmp" % binascii.crc32(normalized.encode())
+
+
+class ConverterHandler(http.server.BaseHTTPRequestHandler):
+    ''' Serve converted maps from the cache directory, taking
+        the url, width, height and output parameters of the
+        Adafruit IO image-formatter '''
+
+    cache_dir = "map_cache"
+
+    def do_GET(self):
+        params = dict(urllib.parse.parse_qsl(urllib.parse.urlsplit(self.path).query))
+        try:
+            url = params["url"]
+            width = int(params["width"])
+            height = int(params["height"])
+        except (KeyError, ValueError):
+            self.send_error(400, "url, width and height are required")
+            return
+        output = params.get("output", "BMP16")
+        if output not in OUTPUT_BITS:
+            self.send_error(400, "Unsupported output " + output)
+            return
+
+        # Convert map, unless cached
+        fname = os.path.join(self.cache_dir, cache_key(url, width, height, output))
+        if not os.path.exists(fname):
+            try:
+                start = time.perf_counter()
+                with urllib.request.urlopen(url, timeout=30) as response:
+                    png = response.read()
+                fetched = time.perf_counter()
+                bmp = convert(png, width, height, output)
+            except (OSError, ValueError) as error:
+                self.send_error(502, "Unable to convert map: %s" % error)
+                return
+            self.log_message(
+                "Converted %s: fetch %.0f ms, convert %.0f ms",
+                fname, (fetched - start) * 1000, (time.perf_counter() - fetched) * 1000
+            )
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with open(fname + ".tmp", "wb") as file:
+                file.write(bmp)
+            os.replace(fname + ".tmp", fname)
+
+        with open(fname, "rb") as file:
+            bmp = file.read()
+        etag = '"%08x"' % binascii.crc32(bmp)
+        modified = email.utils.formatdate(os.stat(fname).st_mtime, usegmt=True)
+
+        # Answer revalidation
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+
+        # Answer range request, unless the client copy is stale
+        start = 0
+        range_header = self.headers.get("Range", "")
+        if range_header.startswith("bytes=") and self.headers.get("If-Range", etag) in (etag, modified):
+            start = int(range_header[6:].split("-")[0] or 0)
+            if start >= len(bmp):
+                self.send_response(416)
+                self.send_header("Content-Range", "bytes */%d" % len(bmp))
+                self.end_headers()
+                return
+
+        self.send_response(206 if start else 200)
+        if start:
+            self.send_header("Content-Range", "bytes %d-%d/%d" % (start, len(bmp) - 1, len(bmp)))
+        self.send_header("Content-Type", "image/bmp")
+        self.send_header("Content-Length", str(len(bmp) - start))
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", modified)
+        self.end_headers()
+        self.wfile.write(bmp[start:])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert Geoapify PNG maps to PyPortal BMP images")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    convert_parser = commands.add_parser("convert", help="convert a PNG file")
+    convert_parser.add_argument("png")
+    convert_parser.add_argument("bmp")
+
+    benchmark_parser = commands.add_parser("benchmark", help="time conversion of a PNG file")
+    benchmark_parser.add_argument("png")
+    benchmark_parser.add_argument("--repeat", type=int, default=3)
+
+    for command in (convert_parser, benchmark_parser):
+        command.add_argument("--width", type=int, default=320)
+        command.add_argument("--height", type=int, default=240)
+    convert_parser.add_argument("--output", choices=sorted(OUTPUT_BITS), default="BMP16")
+
+    serve_parser = commands.add_parser("serve", help="serve converted maps to kiosks")
+    serve_parser.add_argument("--host", default="0.0.0.0")
+    serve_parser.add_argument("--port", type=int, default=8000)
+    serve_parser.add_argument("--cache", default="map_cache")
+
+    args = parser.parse_args()
+    if args.command == "convert":
+        with open(args.png, "rb") as file:
+            png = file.read()
+        with open(args.bmp, "wb") as file:
+            file.write(convert(png, args.width, args.height, args.output))
+    elif args.command == "benchmark":
+        with open(args.png, "rb") as file:
+            benchmark(file.read(), args.width, args.height, args.repeat)
+    else:
+        ConverterHandler.cache_dir = args.cache
+        server = http.server.ThreadingHTTPServer((args.host, args.port), ConverterHandler)
+        print("Serving map conversions on port %d" % args.port)
+        server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()